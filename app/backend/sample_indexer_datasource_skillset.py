@@ -17,6 +17,14 @@ DESCRIPTION:
     The datasource used in this sample is stored as metadata for empty blobs in "searchcontainer".
     The json file can be found in samples/files folder named hotel_small.json has the metdata of
     each blob.
+
+    The embedding skill fans out one request per chunk, which can overwhelm a search service
+    running on a single partition and lead to 503 responses. For anything beyond a small data
+    set, provision the search service with a partitionCount of 2 or more.
+
+    The embedding skill calls Azure OpenAI with the search service's managed identity rather than
+    an API key. Enable the search service's system-assigned identity and grant it the
+    "Cognitive Services OpenAI User" role on the Azure OpenAI resource (infra/main.bicep does this).
 USAGE:
     python sample_indexer_datasource_skillset.py
 
@@ -27,34 +35,24 @@ USAGE:
     being used to create the datasource.
 """
 
+import asyncio
+import functools
 import os
-import datetime
-
+import random
+from dataclasses import dataclass
 
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
+from azure.core.pipeline.policies import AsyncRetryPolicy
+from azure.search.documents.indexes.aio import SearchIndexClient, SearchIndexerClient
 from azure.search.documents.indexes.models import (
-    SearchIndexerDataContainer,
-    SearchIndex,
-    SearchIndexer,
-    SimpleField,
-    SearchField,
-    SearchFieldDataType,
-    EntityRecognitionSkill,
-    InputFieldMappingEntry,
-    OutputFieldMappingEntry,
-    SearchIndexerSkillset,
+    AzureOpenAIEmbeddingSkill,
     CorsOptions,
-    IndexingSchedule,
-    SearchableField,
-    IndexingParameters,
-    SearchIndexerDataSourceConnection,
-    IndexingParametersConfiguration,
-        AzureOpenAIEmbeddingSkill,
-    AzureOpenAIParameters,
-    AzureOpenAIVectorizer,
     FieldMapping,
     HnswAlgorithmConfiguration,
     HnswParameters,
+    IndexingParameters,
+    IndexingParametersConfiguration,
     IndexProjectionMode,
     InputFieldMappingEntry,
     OutputFieldMappingEntry,
@@ -65,36 +63,101 @@ from azure.search.documents.indexes.models import (
     SearchIndexer,
     SearchIndexerDataContainer,
     SearchIndexerDataSourceConnection,
-    SearchIndexerDataSourceType,
     SearchIndexerIndexProjections,
     SearchIndexerIndexProjectionSelector,
     SearchIndexerIndexProjectionsParameters,
     SearchIndexerSkillset,
-    SemanticConfiguration,
-    SemanticField,
-    SemanticPrioritizedFields,
-    SemanticSearch,
     SimpleField,
     SplitSkill,
     VectorSearch,
     VectorSearchAlgorithmMetric,
     VectorSearchProfile,
 )
-from azure.search.documents.indexes import SearchIndexerClient, SearchIndexClient
 from dotenv import load_dotenv
 
-load_dotenv()
 
-service_endpoint = os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"]
-key = os.environ["AZURE_SEARCH_API_KEY"]
-connection_string = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
-
-AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
-AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
-AZURE_OPENAI_EMBEDDING_MODEL = os.environ["AZURE_OPENAI_EMBEDDING_MODEL"]
-AZURE_OPENAI_EMBEDDING_CREDENTIAL =os.environ["AZURE_OPENAI_EMBEDDING_CREDENTIAL"]
-
-def _create_index():
+@dataclass(frozen=True)
+class Config:
+    service_endpoint: str
+    search_credential: AzureKeyCredential
+    connection_string: str
+    azure_openai_embedding_endpoint: str
+    azure_openai_embedding_deployment: str
+    azure_openai_embedding_model: str
+
+
+@functools.lru_cache
+def _config():
+    # Read the environment on first use rather than at import time, so the module can be
+    # imported without a .env file or the variables below being set.
+    load_dotenv()
+    return Config(
+        service_endpoint=os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"],
+        search_credential=AzureKeyCredential(os.environ["AZURE_SEARCH_API_KEY"]),
+        connection_string=os.environ["AZURE_STORAGE_CONNECTION_STRING"],
+        azure_openai_embedding_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+        azure_openai_embedding_deployment=os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+        azure_openai_embedding_model=os.environ["AZURE_OPENAI_EMBEDDING_MODEL"])
+
+
+INDEX_NAME = "gptkbindex"
+INDEXER_NAME = "hotel-data-indexer"
+SKILLSET_NAME = "testtskillset"
+DATA_SOURCE_NAME = "openairagaudio"
+
+# Number of source documents the indexer processes per batch. Blob indexers with a
+# skillset default to very small batches, which leaves most of the throughput unused.
+INDEXER_BATCH_SIZE = 1000
+
+# Polling of the indexer status after a run, with exponential backoff when the service throttles
+INDEXER_POLL_INTERVAL = 10
+INDEXER_BACKOFF_BASE = 2
+INDEXER_BACKOFF_CAP = 120
+INDEXER_MAX_THROTTLED_ATTEMPTS = 8
+INDEXER_WAIT_TIMEOUT = 2 * 60 * 60
+TRANSIENT_STATUS_CODES = (429, 503)
+
+# Maximum number of indexers created and run at the same time, to stay under the service's throttling limits
+MAX_CONCURRENT_INDEXERS = 8
+
+# Clients are created on first use and shared by every stage of the workflow,
+# so the HTTP pipeline (and its TLS session) is only set up once.
+_indexer_client = None
+_index_client = None
+
+
+def _retry_policy():
+    # Let the SDK retry throttled (429/503) requests with backoff before they surface
+    return AsyncRetryPolicy(retry_total=8, retry_backoff_factor=2)
+
+
+def get_indexer_client():
+    global _indexer_client
+    if _indexer_client is None:
+        config = _config()
+        _indexer_client = SearchIndexerClient(config.service_endpoint, config.search_credential, retry_policy=_retry_policy())
+    return _indexer_client
+
+
+def get_index_client():
+    global _index_client
+    if _index_client is None:
+        config = _config()
+        _index_client = SearchIndexClient(config.service_endpoint, config.search_credential, retry_policy=_retry_policy())
+    return _index_client
+
+
+async def close_clients():
+    global _indexer_client, _index_client
+    if _indexer_client is not None:
+        await _indexer_client.close()
+        _indexer_client = None
+    if _index_client is not None:
+        await _index_client.close()
+        _index_client = None
+
+
+async def _create_index(index_client):
     name = "hotel-index"
 
     # Here we create an index with listed fields.
@@ -108,56 +171,75 @@ def _create_index():
                 type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                 vector_search_dimensions=1536,
                 vector_search_profile_name="vp",
-                stored=True,
-                hidden=False)
-        ],
+                # Searchable but not stored: the vector is never returned, so skip the retrievable copy
+                stored=False,
+                hidden=True)
+        ]
     cors_options = CorsOptions(allowed_origins=["*"], max_age_in_seconds=60)
 
-    # pass in the name, fields and cors options and create the index
-    index = SearchIndex(name=name, fields=fields, cors_options=cors_options)
-    index_client = SearchIndexClient(service_endpoint, AzureKeyCredential(key))
-    result = index_client.create_index(index)
+    # Define the "vp" profile used by text_vector explicitly instead of relying on HNSW defaults
+    vector_search = VectorSearch(
+        algorithms=[
+            HnswAlgorithmConfiguration(
+                name="hnsw",
+                parameters=HnswParameters(m=4, ef_construction=200, ef_search=100, metric=VectorSearchAlgorithmMetric.COSINE))
+        ],
+        profiles=[
+            VectorSearchProfile(name="vp", algorithm_configuration_name="hnsw")
+        ])
+
+    # pass in the name, fields, cors options and vector search configuration and create the index
+    index = SearchIndex(name=name, fields=fields, cors_options=cors_options, vector_search=vector_search)
+    result = await index_client.create_index(index)
     return result
 
 
-def _create_datasource():
+# This sample ingests with an indexer (pull mode). If documents are ever pushed to the index
+# directly, use azure.search.documents.aio.SearchIndexingBufferedSender rather than batching
+# upload_documents calls by hand: it batches, sends concurrently and retries failed actions.
+
+
+async def _create_datasource(ds_client):
     # Here we create a datasource. As mentioned in the description we have stored it in
     # "searchcontainer"
-    ds_client = SearchIndexerClient(service_endpoint, AzureKeyCredential(key))
     container = SearchIndexerDataContainer(name="documentation")
     data_source_connection = SearchIndexerDataSourceConnection(
-        name="openairagaudio", type="azureblob", connection_string=connection_string, container=container
+        name=DATA_SOURCE_NAME, type="azureblob", connection_string=_config().connection_string, container=container
     )
-    data_source = ds_client.create_data_source_connection(data_source_connection)
+    data_source = await ds_client.create_or_update_data_source_connection(data_source_connection)
     return data_source
 
 
-def _create_skillset():
-    client = SearchIndexerClient(service_endpoint, AzureKeyCredential(key))
-    skillset=SearchIndexerSkillset(
-        name="testtskillset",
+@functools.lru_cache
+def _skillset_spec():
+    # The skillset definition is pure data, so build it once per process and reuse it.
+    config = _config()
+    return SearchIndexerSkillset(
+        name=SKILLSET_NAME,
         skills=[
             SplitSkill(
                 text_split_mode="pages",
                 context="/document",
-                maximum_page_length=2000,
-                page_overlap_length=500,
+                maximum_page_length=8000,
+                page_overlap_length=800,
                 inputs=[InputFieldMappingEntry(name="text", source="/document/content")],
                 outputs=[OutputFieldMappingEntry(name="textItems", target_name="pages")]),
             AzureOpenAIEmbeddingSkill(
                 context="/document/pages/*",
-                resource_uri=AZURE_OPENAI_EMBEDDING_ENDPOINT,
-                api_key=AZURE_OPENAI_EMBEDDING_CREDENTIAL,
-                deployment_id=AZURE_OPENAI_EMBEDDING_ENDPOINT,
-                model_name=AZURE_OPENAI_EMBEDDING_MODEL,
+                resource_uri=config.azure_openai_embedding_endpoint,
+                deployment_id=config.azure_openai_embedding_deployment,
+                model_name=config.azure_openai_embedding_model,
                 dimensions=1536,
                 inputs=[InputFieldMappingEntry(name="text", source="/document/pages/*")],
                 outputs=[OutputFieldMappingEntry(name="embedding", target_name="text_vector")])
         ],
+        # The key (chunk_id) of each projected chunk is generated by the service from the parent
+        # document key and the page index, so it can't be mapped here. Both are stable across runs,
+        # so re-indexing a blob overwrites its chunks in place rather than adding duplicates.
         index_projections=SearchIndexerIndexProjections(
             selectors=[
                 SearchIndexerIndexProjectionSelector(
-                    target_index_name="gptkbindex",
+                    target_index_name=INDEX_NAME,
                     parent_key_field_name="parent_id",
                     source_context="/document/pages/*",
                     mappings=[
@@ -171,55 +253,142 @@ def _create_skillset():
                 projection_mode=IndexProjectionMode.SKIP_INDEXING_PARENT_DOCUMENTS
             )
         ))
-    result = client.create_skillset(skillset)
-    return result
-
 
-def sample_indexer_workflow():
-    # Now that we have a datasource and an index, we can create an indexer.
-
-    skillset_name = _create_skillset().name
-    print("Skillset is created")
-
-    ds_name = _create_datasource().name
-    print("Data source is created")
-
-    #ind_name = _create_index().name
-    #print("Index is created")
-
-    # we pass the data source, skillsets and targeted index to build an indexer
-    #configuration = IndexingParametersConfiguration(parsing_mode="jsonArray", query_timeout=None)
-    #parameters = IndexingParameters(configuration=configuration)
-    indexer = SearchIndexer(
-        name="hotel-data-indexer",
-        data_source_name=ds_name,
-        target_index_name="gptkbindex",
-        skillset_name=skillset_name,
-        #parameters=parameters,
-        field_mappings=[FieldMapping(source_field_name="metadata_storage_name", target_field_name="title")]
-    )
-
-    indexer_client = SearchIndexerClient(service_endpoint, AzureKeyCredential(key))
-    indexer_client.create_indexer(indexer)  # create the indexer
-
-    # to get an indexer
-    result = indexer_client.get_indexer("hotel-data-indexer")
-    print(result)
 
-    # To run an indexer, we can use run_indexer()
-    indexer_client.run_indexer(result.name)
-
-    # Using create or update to schedule an indexer
-
-    #schedule = IndexingSchedule(interval=datetime.timedelta(hours=24))
-    #result.schedule = schedule
-    #updated_indexer = indexer_client.create_or_update_indexer(result)
+async def _create_skillset(client):
+    result = await client.create_or_update_skillset(_skillset_spec())
+    return result
 
-    #print(updated_indexer)
 
-    # get the status of an indexer
-    #indexer_client.get_indexer_status(updated_indexer.name)
+def _last_finished_start_time(status):
+    # Start time of the most recent run that has finished, or None if no run has finished yet
+    for execution in [status.last_result, *(status.execution_history or [])]:
+        if execution is not None and execution.status != "inProgress":
+            return execution.start_time
+    return None
+
+
+async def _wait_for_indexer(client, name, previous_start_time):
+    # Poll the indexer until its current run finishes. Throttling errors are retried with
+    # exponential backoff and jitter instead of being surfaced to the caller.
+    # run_indexer only queues a run, so until the new run shows up the status still reports
+    # the previous one. Only a finished run that started strictly after previous_start_time
+    # (taken from the service before starting the run) counts, so no local clock is involved.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + INDEXER_WAIT_TIMEOUT
+    attempt = 0
+    while True:
+        if loop.time() > deadline:
+            raise TimeoutError(f"Indexer {name} run did not finish within {INDEXER_WAIT_TIMEOUT} seconds")
+        try:
+            # retry_total=0 disables the client's retry policy for this call, so the manual
+            # backoff below is the only retry layer while polling and stays within the deadline
+            status = await client.get_indexer_status(name, retry_total=0)
+        except HttpResponseError as e:
+            if e.status_code not in TRANSIENT_STATUS_CODES or attempt >= INDEXER_MAX_THROTTLED_ATTEMPTS:
+                raise
+            delay = min(INDEXER_BACKOFF_CAP, INDEXER_BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 1)
+            delay = min(delay, max(0, deadline - loop.time()))
+            attempt += 1
+            print(f"Indexer status request throttled ({e.status_code}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        attempt = 0
+        # Only an error ends the wait early; "unknown" just means the new run isn't visible yet
+        if status.status == "error":
+            raise Exception(f"Indexer {name} is in an error state")
+        last_result = status.last_result
+        if (last_result is not None
+                and last_result.status != "inProgress"
+                and (previous_start_time is None or last_result.start_time > previous_start_time)):
+            return status
+        await asyncio.sleep(min(INDEXER_POLL_INTERVAL, max(0, deadline - loop.time())))
+
+
+async def _submit_indexer(client, semaphore, indexer):
+    async with semaphore:
+        result = await client.create_or_update_indexer(indexer)  # create or update the indexer
+        print(result)
+
+        # Remember the last finished run, so its result isn't mistaken for the one started below
+        previous_start_time = _last_finished_start_time(await client.get_indexer_status(result.name))
+
+        # To run an indexer, we can use run_indexer()
+        try:
+            await client.run_indexer(result.name)
+        except ResourceExistsError:
+            # The run already in progress is newer than the last finished one, so it is waited on instead
+            print(f"Indexer {result.name} already running, not starting again")
+
+        # get the status of an indexer once the run completes
+        status = await _wait_for_indexer(client, result.name, previous_start_time)
+        print(f"Indexer {result.name} run finished with status: {status.last_result.status}")
+
+        # Using create or update to schedule an indexer
+
+        #schedule = IndexingSchedule(interval=datetime.timedelta(hours=24))
+        #result.schedule = schedule
+        #updated_indexer = await client.create_or_update_indexer(result)
+
+        #print(updated_indexer)
+        return status
+
+
+async def _run_indexers(client, indexers):
+    # Create and run indexers concurrently, e.g. one per container or prefix, while
+    # bounding how many are in flight at once.
+    # Every task is allowed to finish before failures are raised, so none of them is
+    # still using the shared client when the caller closes it.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_INDEXERS)
+    results = await asyncio.gather(
+        *(_submit_indexer(client, semaphore, indexer) for indexer in indexers),
+        return_exceptions=True)
+    failures = [(indexer, result) for indexer, result in zip(indexers, results) if isinstance(result, BaseException)]
+    for indexer, error in failures:
+        print(f"Indexer {indexer.name} failed: {error!r}")
+    if failures:
+        raise failures[0][1]
+    return results
+
+
+async def sample_indexer_workflow():
+    # Now that we have a datasource and an index, we can create an indexer.
+    indexer_client = get_indexer_client()
+    try:
+        # The skillset and the data source don't depend on each other, so create them concurrently
+        await asyncio.gather(
+            _create_skillset(indexer_client),
+            _create_datasource(indexer_client))
+        print("Skillset and data source are created")
+
+        #ind_name = (await _create_index(get_index_client())).name
+        #print("Index is created")
+
+        # we pass the data source, skillsets and targeted index to build an indexer
+        configuration = IndexingParametersConfiguration(
+            parsing_mode="default",
+            query_timeout=None,
+            indexed_file_name_extensions=".pdf,.md,.txt",
+            data_to_extract="contentAndMetadata")
+        parameters = IndexingParameters(
+            batch_size=INDEXER_BATCH_SIZE,
+            max_failed_items=-1,
+            max_failed_items_per_batch=-1,
+            configuration=configuration)
+        indexer = SearchIndexer(
+            name=INDEXER_NAME,
+            data_source_name=DATA_SOURCE_NAME,
+            target_index_name=INDEX_NAME,
+            skillset_name=SKILLSET_NAME,
+            parameters=parameters,
+            field_mappings=[FieldMapping(source_field_name="metadata_storage_name", target_field_name="title")]
+        )
+
+        await _run_indexers(indexer_client, [indexer])
+    finally:
+        await close_clients()
 
 
 if __name__ == "__main__":
-    sample_indexer_workflow()
\ No newline at end of file
+    asyncio.run(sample_indexer_workflow())
\ No newline at end of file